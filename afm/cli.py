@@ -1,32 +1,430 @@
 """Main Entry Point."""
 
 import os
+import sys
 
-from collections import defaultdict
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from pprint import pprint
-from urllib.parse import urlparse
-import requests
+import io
+from pprint import pformat
 
 import click
 from dotenv import load_dotenv, find_dotenv
-from twilio.rest import Client
-import psycopg2
-import psycopg2.extras
+
+# asyncio and the HTTP, Twilio, Postgres and PyArrow libraries are slow to import, so they are
+# imported inside the commands that need them to keep CLI startup fast.
+
+
+_dotenv_loaded = False    # pylint:disable=invalid-name
+_client = None    # pylint:disable=invalid-name
+_client_lock = threading.Lock()
+_db_pool = None    # pylint:disable=invalid-name
+_db_pool_lock = threading.Lock()
+
+# Maximum number of Twilio lookups in flight at once
+LOOKUP_CONCURRENCY = 32
+# Maximum number of numbers purchased at once
+PURCHASE_CONCURRENCY = 16
+# OSDI canvass endpoint, formatted with a person's external ID
+VAN_CANVASS_URL = 'https://osdi.ngpvan.com/api/v1/people/{}/record_canvass_helper/'
+# Maximum number of VAN requests in flight at once
+VAN_CONCURRENCY = 32
+# Number of times a failed VAN request is retried, and the base delay between tries
+VAN_RETRIES = 3
+VAN_BACKOFF_FACTOR = 0.2
+# Longest Retry-After, in seconds, that is waited out; longer waits are reported as failures
+VAN_MAX_RETRY_DELAY = 60
+# Response statuses that are worth retrying, on top of failed connections. Canvass posts are not
+# idempotent, so only statuses that guarantee the canvass was not recorded are retried.
+VAN_RETRY_STATUSES = frozenset([429])
+# Number of rows buffered before each csv writerows call
+WRITE_BATCH_SIZE = 1024
+# Buffer size for large output csvs
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Characters removed from cell numbers before normalising them
+CELL_STRIP_CHARS = ' ()-.\t\r\n'
+CELL_STRIP_TABLE = str.maketrans('', '', CELL_STRIP_CHARS)
+# The same characters as a regex class for Arrow, each written as a hex escape
+CELL_STRIP_PATTERN = '[' + ''.join(f'\\x{ord(char):02x}' for char in CELL_STRIP_CHARS) + ']'
+# Maximum number of pooled Postgres connections
+DB_POOL_SIZE = 8
+# Number of rows fetched per round-trip when streaming from a server-side cursor
+DB_ITERSIZE = 2000
+
+
+def getenv(name):
+    """Return an environment setting, loading the .env file on first use."""
+    global _dotenv_loaded    # pylint:disable=global-statement,invalid-name
+    if not _dotenv_loaded:
+        load_dotenv(find_dotenv())
+        _dotenv_loaded = True
+    return os.getenv(name, None)
+
+
+def create_client():
+    """Create a Twilio client that reuses pooled keep-alive connections."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=LOOKUP_CONCURRENCY))
+    http_client = TwilioHttpClient()
+    http_client.session = session
+    return Client(getenv('TWILIO_ACCOUNT_SID'), getenv('TWILIO_AUTH_TOKEN'),
+                  http_client=http_client)
+
+
+def get_client():
+    """Return the shared Twilio client, creating it on first use.
+
+    Creation is locked because the first callers may be lookup threads running concurrently.
+    """
+    global _client    # pylint:disable=global-statement,invalid-name
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+    return _client
 
 
-load_dotenv(find_dotenv())
-VAN_API_KEY = os.getenv('VAN_API_KEY', None)
-DATABASE_URL = os.getenv('DATABASE_URL', None)
-ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID', None)
-AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN', None)
-client = Client(ACCOUNT_SID, AUTH_TOKEN)    # pylint:disable=invalid-name
+def get_db_pool():
+    """Return the shared Postgres connection pool, creating it on first use."""
+    from psycopg2.pool import ThreadedConnectionPool
+
+    global _db_pool    # pylint:disable=global-statement,invalid-name
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = ThreadedConnectionPool(1, DB_POOL_SIZE, dsn=getenv('DATABASE_URL'))
+    return _db_pool
 
 
 def format_cell(cell):
-    """Ensure cell numbers have a leading +1."""
-    cell_ten = cell[-10:]
-    return f'+1{cell_ten}'
+    """Ensure cell numbers have a leading +1, dropping any punctuation and whitespace."""
+    return '+1' + cell.translate(CELL_STRIP_TABLE)[-10:]
+
+
+def retry_delay(headers, attempt):
+    """Return how long to wait before retrying a VAN request.
+
+    Honours a Retry-After header given in seconds, otherwise backs off exponentially.
+    """
+    try:
+        return max(0, int(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return VAN_BACKOFF_FACTOR * 2 ** attempt
+
+
+def echo_lines(lines):
+    """Echo a sequence of lines with a single write."""
+    output = '\n'.join(lines)
+    if output:
+        click.echo(output)
+
+
+def csv_rows(reader, width=0):
+    """Yield the rows of a `csv.reader`, skipping blank lines, which it returns as empty rows.
+
+    Rows with fewer than `width` fields are padded with empty strings, so that indexing them
+    behaves like the missing fields that `csv.DictReader` fills in.
+    """
+    for row in reader:
+        if not row:
+            continue
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        yield row
+
+
+def cell_key(cell):
+    """Return the last 10 digits of a cell number as an int, for compact set membership.
+
+    Only full 10 digit numbers become ints, since shorter ones would lose their leading zeros and
+    collide; anything else falls back to its normalised string.
+    """
+    digits = cell.translate(CELL_STRIP_TABLE)[-10:]
+    if len(digits) == 10 and digits.isdigit():
+        return int(digits)
+    return digits
+
+
+def dedup_rows(superset_csv, subset_csv, csv_output):
+    """Filter superset_csv against subset_csv row by row with the csv module.
+
+    Returns a (duplicate count, remaining count) tuple.
+    """
+    subset_reader = csv.reader(subset_csv)
+    subset_cell_index = next(subset_reader).index('contact[cell]')
+    # Compare on compact integer keys rather than building formatted +1 numbers
+    subset_numbers = {cell_key(row[subset_cell_index]) for row in csv_rows(subset_reader)}
+
+    superset_reader = csv.reader(superset_csv)
+    fieldnames = next(superset_reader)
+    cell_index = fieldnames.index('cell')
+    writer = csv.writer(csv_output, lineterminator='\n')
+    writer.writerow(fieldnames)
+
+    dup_count = 0
+    untouched_count = 0
+    pending = []
+    for row in csv_rows(superset_reader):
+        if cell_key(row[cell_index]) not in subset_numbers:
+            pending.append(row)
+            if len(pending) >= WRITE_BATCH_SIZE:
+                writer.writerows(pending)
+                pending.clear()
+            untouched_count += 1
+        else:
+            dup_count += 1
+    writer.writerows(pending)
+
+    return dup_count, untouched_count
+
+
+def has_pyarrow():
+    """Return whether the optional pyarrow dependency is installed."""
+    try:
+        import pyarrow.compute    # noqa: F401 pylint:disable=unused-import
+        import pyarrow.csv    # noqa: F401 pylint:disable=unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def read_csv_as_strings(csv_file):
+    """Read a csv file into a pyarrow Table, keeping every column as a string."""
+    import pyarrow
+    import pyarrow.csv
+
+    # Name the columns exactly as the csv module reads them; Arrow's own header parsing would strip
+    # a leading byte order mark, leaving the first column untyped and renamed
+    fieldnames = next(csv.reader(csv_file))
+    read_options = pyarrow.csv.ReadOptions(column_names=fieldnames, skip_rows=1)
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types={name: pyarrow.string() for name in fieldnames}
+    )
+    return pyarrow.csv.read_csv(csv_file.name, read_options=read_options,
+                                convert_options=convert_options)
+
+
+def arrow_cell_keys(cells):
+    """Vectorised equivalent of `cell_key` for a pyarrow string column."""
+    import pyarrow.compute
+
+    digits = pyarrow.compute.replace_substring_regex(cells, CELL_STRIP_PATTERN, '')
+    return pyarrow.compute.utf8_slice_codeunits(digits, start=-10)
+
+
+def dedup_arrow(superset_csv, subset_csv, csv_output):
+    """Filter superset_csv against subset_csv with a vectorised pyarrow set difference.
+
+    Both inputs must be files on disk. Returns a (duplicate count, remaining count) tuple.
+    """
+    import pyarrow.compute
+
+    subset = read_csv_as_strings(subset_csv)
+    superset = read_csv_as_strings(superset_csv)
+
+    subset_numbers = pyarrow.compute.unique(arrow_cell_keys(subset['contact[cell]']))
+    is_duplicate = pyarrow.compute.is_in(arrow_cell_keys(superset['cell']),
+                                         value_set=subset_numbers)
+    remaining = superset.filter(pyarrow.compute.invert(is_duplicate))
+
+    # Arrow's csv writer quotes every string, so write through the csv module to keep the output
+    # identical to the row by row path
+    writer = csv.writer(csv_output, lineterminator='\n')
+    writer.writerow(remaining.column_names)
+    for batch in remaining.to_batches(max_chunksize=WRITE_BATCH_SIZE):
+        writer.writerows(zip(*(column.to_pylist() for column in batch.columns)))
+
+    return superset.num_rows - remaining.num_rows, remaining.num_rows
+
+
+def lookup_carrier(destination):
+    """Return the carrier name for a +1 formatted destination number."""
+    phone_number = get_client().lookups.phone_numbers(destination).fetch(type='carrier')
+    carrier_name = phone_number.carrier['name']
+    # Runs once per distinct destination, so interning lets rows share one name string
+    return sys.intern(carrier_name) if carrier_name else carrier_name
+
+
+def purchase_number(area_code, phone_number, service_sid=None):
+    """Purchase a Twilio number, optionally adding it to a messaging service.
+
+    Returns a result row for the purchase output csv.
+    """
+    row = {
+        'area_code': area_code,
+        'number': phone_number
+    }
+
+    client = get_client()
+
+    # Purchase number
+    incoming_phone_number = None
+    try:
+        incoming_phone_number = client.incoming_phone_numbers.create(phone_number=phone_number)
+        row['purchase_status'] = 'success'
+    except Exception as exc:        # pylint:disable=broad-except
+        row['purchase_status'] = 'error'
+        row['message'] = str(exc)
+
+    # Add to messaging service, using the SID returned by the purchase
+    if service_sid and incoming_phone_number is not None:
+        try:
+            client.messaging \
+                .services(service_sid) \
+                .phone_numbers \
+                .create(phone_number_sid=incoming_phone_number.sid)
+            row['service_status'] = 'success'
+        except Exception as exc:    # pylint:disable=broad-except
+            row['service_status'] = 'error'
+            row['message'] = str(exc)
+
+    return row
+
+
+async def write_carrier_rows(rows, writer, error_index, to_index):
+    """Look up carriers for 30007 rows concurrently and write all rows in their original order.
+
+    Rows are lists as produced by `csv.reader`; `error_index` and `to_index` are the positions of
+    the 'ErrorCode' and 'To' columns. Each row is written with its carrier appended, and each
+    distinct destination is only looked up once.
+
+    Returns the carrier name of every looked up row, in row order.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    # The executor's worker count is what bounds the number of lookups in flight
+    with ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY) as executor:
+        def lookup(destination):
+            return loop.run_in_executor(executor, lookup_carrier, destination)
+
+        # One lookup per distinct destination; repeated numbers share the pending result. Numbers
+        # are normalised first so that differently formatted copies of a number share it too.
+        destinations = [format_cell(row[to_index]) if row[error_index] == '30007' else None
+                        for row in rows]
+        lookups = {}
+        for destination in destinations:
+            if destination is not None and destination not in lookups:
+                lookups[destination] = asyncio.ensure_future(lookup(destination))
+
+        carriers = []
+        pending = []
+        for row, destination in zip(rows, destinations):
+            if destination is not None:
+                carrier_name = await lookups[destination]
+                row.append(carrier_name)
+                carriers.append(carrier_name)
+            else:
+                row.append('')
+            pending.append(row)
+            if len(pending) >= WRITE_BATCH_SIZE:
+                writer.writerows(pending)
+                pending.clear()
+        writer.writerows(pending)
+
+    return carriers
+
+
+async def post_canvass_responses(cursor, progress_bar, api_key):
+    """Send survey response records to VAN concurrently over one keep-alive session.
+
+    Each record is an (external id, JSON body) tuple. Records are fetched from `cursor` in batches
+    on a worker thread, so the next database round-trip overlaps with the requests for the
+    current batch. They are fed through a bounded queue to a fixed pool of workers.
+
+    Returns a list of (external id, status code, reason) for every failed request. Requests that
+    never got a response are reported with a status code of None.
+    """
+    import asyncio
+
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=DB_ITERSIZE)
+    errors = []
+    connector = aiohttp.TCPConnector(limit=VAN_CONCURRENCY, keepalive_timeout=60,
+                                     ttl_dns_cache=300)
+    headers = {
+        'OSDI-Api-Token': api_key,
+        'Content-type': 'application/hal+json',
+    }
+
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        async def send(url, body):
+            for attempt in range(VAN_RETRIES + 1):
+                delay = VAN_BACKOFF_FACTOR * 2 ** attempt
+                try:
+                    async with session.post(url, data=body) as result:
+                        if result.status not in VAN_RETRY_STATUSES or attempt == VAN_RETRIES:
+                            return result.status, result.reason
+                        delay = retry_delay(result.headers, attempt)
+                        if delay > VAN_MAX_RETRY_DELAY:
+                            # Don't hold a worker for hours on one contact
+                            return result.status, result.reason
+                except aiohttp.ClientConnectorError as exc:
+                    # The connection was never made, so the canvass cannot have been recorded.
+                    # Report a persistent failure for this contact rather than aborting the sync
+                    if attempt == VAN_RETRIES:
+                        return None, str(exc) or type(exc).__name__
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                    # The body may already have reached VAN, so re-sending could record it twice
+                    return None, str(exc) or type(exc).__name__
+                await asyncio.sleep(delay)
+
+        async def post(record):
+            cc_external_id, body = record
+
+            status, reason = await send(VAN_CANVASS_URL.format(cc_external_id), body)
+            if status != 200:
+                errors.append((cc_external_id, status, reason))
+
+        async def produce():
+            fetch = loop.run_in_executor(None, cursor.fetchmany, DB_ITERSIZE)
+            while True:
+                records = await fetch
+                if not records:
+                    break
+                fetch = loop.run_in_executor(None, cursor.fetchmany, DB_ITERSIZE)
+                for record in records:
+                    await queue.put(record)
+            for _ in range(VAN_CONCURRENCY):
+                await queue.put(None)
+
+        async def consume():
+            while True:
+                record = await queue.get()
+                if record is None:
+                    return
+                await post(record)
+                progress_bar.update(1)
+
+        await asyncio.gather(produce(), *[consume() for _ in range(VAN_CONCURRENCY)])
+
+    return errors
+
+
+class BufferedFile(click.File):
+    """A click.File that opens files on disk with a large write buffer.
+
+    '-' still maps to stdout, as with click.File.
+    """
+
+    def convert(self, value, param, ctx):
+        if value == '-' or hasattr(value, 'write'):
+            return super().convert(value, param, ctx)
+        try:
+            csv_file = open(value, self.mode, buffering=OUTPUT_BUFFER_SIZE)
+        except OSError as exc:
+            self.fail(f'Could not open file: {value}: {exc.strerror}', param, ctx)
+        if ctx is not None:
+            ctx.call_on_close(csv_file.close)
+        return csv_file
 
 
 @click.group()
@@ -44,46 +442,39 @@ def analysis():
 @click.argument('csv-input', type=click.File('r'))
 def number_stats(csv_input):
     """Breakdown Twilio send/receive logs to find number of texts sent from each Twilio number."""
-    reader = csv.DictReader(csv_input)
-
-    from_number_count = defaultdict(int)
+    reader = csv.reader(csv_input)
+    header = next(reader)
+    from_index = header.index('From')
+    direction_index = header.index('Direction')
 
-    for row in reader:
-        if row['Direction'] != 'inbound':
-            from_number_count[row['From']] += 1
+    from_number_count = Counter(row[from_index] for row in csv_rows(reader, len(header))
+                                if row[direction_index] != 'inbound')
 
     click.echo('Breakdown by number sent from:')
-    for key, value in from_number_count.items():
-        click.echo(f'{key}: {value}')
+    echo_lines(f'{key}: {value}' for key, value in from_number_count.items())
 
 
 @analysis.command()
 @click.argument('superset-csv', type=click.File('r'))
 @click.argument('subset-csv', type=click.File('r'))
-@click.argument('csv-output', type=click.File('w'))
+@click.argument('csv-output', type=BufferedFile('w'))
 def dedup(superset_csv, subset_csv, csv_output):
     """Remove all the numbers in subset-csv from superset-csv, saving the result to the output."""
-    superset_reader = csv.DictReader(superset_csv)
-    subset_reader = csv.DictReader(subset_csv)
+    counts = None
+    if has_pyarrow() and all(os.path.isfile(csv_file.name)
+                             for csv_file in (superset_csv, subset_csv)):
+        import pyarrow
 
-    fieldnames = superset_reader.fieldnames
-    writer = csv.DictWriter(csv_output,
-                            lineterminator='\n',
-                            fieldnames=fieldnames)
-    writer.writeheader()
-
-    subset_numbers = set([format_cell(row['contact[cell]'])
-                          for row in subset_reader])
-
-    dup_count = 0
-    untouched_count = 0
-    for row in superset_reader:
-        cell = format_cell(row['cell'])
-        if cell not in subset_numbers:
-            writer.writerow(row)
-            untouched_count += 1
-        else:
-            dup_count += 1
+        try:
+            counts = dedup_arrow(superset_csv, subset_csv, csv_output)
+        except pyarrow.ArrowInvalid:
+            # Arrow rejects ragged rows that the csv module accepts, so start over row by row.
+            # Nothing has been written yet, since both inputs are parsed before any output.
+            superset_csv.seek(0)
+            subset_csv.seek(0)
+    if counts is None:
+        counts = dedup_rows(superset_csv, subset_csv, csv_output)
+    dup_count, untouched_count = counts
 
     click.echo(f'Removed {dup_count} duplicate numbers.')
     click.echo(f'There were {untouched_count} remaining numbers.')
@@ -99,18 +490,16 @@ def twilio():
 @click.option('--group-by-area-code', '-g', is_flag=True, help='Group by area code.')
 def count(group_by_area_code):
     """Return the number of phone numbers."""
+    client = get_client()
     incoming_phone_numbers = client.incoming_phone_numbers.list()
     phone_number_count = len(incoming_phone_numbers)
     click.echo(f'Number of Twilio SMS Numbers: {phone_number_count}')
 
     if group_by_area_code:
         click.echo('\nBy area code:')
-        area_codes = defaultdict(lambda: 0)
-        for number in incoming_phone_numbers:
-            area_code = number.phone_number[2:5]
-            area_codes[area_code] += 1
-        for area_code, number_count in area_codes.items():
-            click.echo(f'({area_code}): {number_count}')
+        area_codes = Counter(number.phone_number[2:5] for number in incoming_phone_numbers)
+        echo_lines(f'({area_code}): {number_count}'
+                   for area_code, number_count in area_codes.items())
 
 
 @twilio.command()
@@ -125,12 +514,24 @@ def purchase(csv_input, csv_output, auto_purchase, service_sid):
 
     Accepts a csv with 'area_code' and 'quantity' columns.
     """
-    reader = csv.DictReader(csv_input)
+    client = get_client()
+    reader = csv.reader(csv_input)
+    header = next(reader)
+    area_code_index = header.index('area_code')
+    quantity_index = header.index('quantity')
+    requested = [(row[area_code_index], int(row[quantity_index]))
+                 for row in csv_rows(reader)]
+
+    # Search every area code at once, then walk the results in input order
+    def list_available(area_code):
+        return client.available_phone_numbers('US').local.list(area_code=area_code)
+
+    with ThreadPoolExecutor(max_workers=PURCHASE_CONCURRENCY) as executor:
+        available = list(executor.map(list_available,
+                                      [area_code for area_code, _ in requested]))
+
     purchase_order = {}
-    for row in reader:
-        area_code = row['area_code']
-        requested_quantity = int(row['quantity'])
-        numbers = client.available_phone_numbers('US').local.list(area_code=area_code)
+    for (area_code, requested_quantity), numbers in zip(requested, available):
         available_count = len(numbers)
         if available_count == 0:
             click.echo((f'Area code ({area_code}) has {available_count} available numbers. '
@@ -145,9 +546,8 @@ def purchase(csv_input, csv_output, auto_purchase, service_sid):
         purchase_order[area_code] = numbers[0:requested_quantity]
 
     click.echo('Please confirm your order:')
-    for area_code, number_list in purchase_order.items():
-        number_count = len(number_list)
-        click.echo(f'({area_code}): {number_count}')
+    echo_lines(f'({area_code}): {len(number_list)}'
+               for area_code, number_list in purchase_order.items())
     if click.confirm('\nIs this correct?', abort=True):
         fieldnames = ['area_code', 'number', 'purchase_status', 'service_status', 'message']
         writer = csv.DictWriter(csv_output,
@@ -155,41 +555,13 @@ def purchase(csv_input, csv_output, auto_purchase, service_sid):
                                 fieldnames=fieldnames)
         writer.writeheader()
 
-        results = {'success': 0, 'error': 0}
-        for area_code, number_list in purchase_order.items():
-            results[area_code] = {}
-            for number in number_list:
-                phone_number = number.phone_number
-                row = {
-                    'area_code': area_code,
-                    'number': phone_number
-                }
-
-                # Purchase number
-                try:
-                    client.incoming_phone_numbers.create(phone_number=phone_number)
-                    row['purchase_status'] = 'success'
-                except Exception as exc:        # pylint:disable=broad-except
-                    row['purchase_status'] = 'error'
-                    row['message'] = str(exc)
-
-                # Add to messaging service
-                if service_sid:
-                    try:
-                        incoming_phone_number = client.incoming_phone_numbers.list(
-                            phone_number=phone_number
-                        )[0]
-                        phone_number_sid = incoming_phone_number.sid
-                        phone_number = client.messaging \
-                            .services(service_sid) \
-                            .phone_numbers \
-                            .create(phone_number_sid=phone_number_sid)
-                        row['service_status'] = 'success'
-                    except Exception as exc:    # pylint:disable=broad-except
-                        row['service_status'] = 'error'
-                        row['message'] = str(exc)
-
-                writer.writerow(row)
+        orders = [(area_code, number.phone_number)
+                  for area_code, number_list in purchase_order.items()
+                  for number in number_list]
+        with ThreadPoolExecutor(max_workers=PURCHASE_CONCURRENCY) as executor:
+            # writerows consumes the results in order, writing each row as soon as it is ready
+            writer.writerows(executor.map(lambda order: purchase_number(*order, service_sid),
+                                          orders))
 
 
 @twilio.group()
@@ -202,7 +574,7 @@ def service():
 @click.argument('service-sid')
 def count(service_sid):
     """Get number of phone numbers in a service."""
-    phone_numbers = client.messaging \
+    phone_numbers = get_client().messaging \
         .services(service_sid) \
         .phone_numbers \
         .list()
@@ -215,61 +587,66 @@ def count(service_sid):
 @click.argument('service-sid')
 def add(csv_input, service_sid):
     """Add numbers to a messaging service."""
+    client = get_client()
+
+    # Fetch every number once rather than looking each one up individually. Both sides are
+    # normalised so that unformatted numbers in the csv still match.
+    sid_by_number = {format_cell(number.phone_number): number.sid
+                     for number in client.incoming_phone_numbers.list()}
+
     reader = csv.DictReader(csv_input)
+    phone_number_sids = []
     for row in reader:
         phone_number = row['number']
-        incoming_phone_number = client.incoming_phone_numbers.list(phone_number=phone_number)[0]
-        phone_number_sid = incoming_phone_number.sid
-        phone_number = client.messaging \
+        phone_number_sid = sid_by_number.get(format_cell(phone_number))
+        if phone_number_sid is None:
+            click.echo(f'Number {phone_number} was not found. Skipping.')
+            continue
+        phone_number_sids.append(phone_number_sid)
+
+    def add_number(phone_number_sid):
+        client.messaging \
             .services(service_sid) \
             .phone_numbers \
             .create(phone_number_sid=phone_number_sid)
 
+    with ThreadPoolExecutor(max_workers=PURCHASE_CONCURRENCY) as executor:
+        # Consume the results so that any API error is raised here
+        list(executor.map(add_number, phone_number_sids))
+
 
 @twilio.command()
 @click.argument('csv-input', type=click.File('r'))
-@click.argument('csv-output', type=click.File('w'))
+@click.argument('csv-output', type=BufferedFile('w'))
 @click.option('--quiet', '-q', is_flag=True, help='Do not print stats. Only write to output csv.')
 def sms(csv_input, csv_output, quiet):
     """Lookup carrier information from an input Twilio error log csv and
     write an Output csv with additional 'Carrier' column.
     """
-    reader = csv.DictReader(csv_input)
-    fieldnames = reader.fieldnames + ['Carrier']
-    writer = csv.DictWriter(csv_output,
-                            lineterminator='\n',
-                            fieldnames=fieldnames)
-    writer.writeheader()
+    import asyncio
 
-    error_count = defaultdict(int)
-    carrier_count = defaultdict(int)
+    reader = csv.reader(csv_input)
+    header = next(reader)
+    error_index = header.index('ErrorCode')
+    to_index = header.index('To')
+    writer = csv.writer(csv_output, lineterminator='\n')
+    writer.writerow(header + ['Carrier'])
 
-    for row in reader:
-        error_code = row['ErrorCode']
-        error_count[error_code] += 1
-
-        if error_code == '30007':
-            destination = row['To']
-            phone_number = client.lookups.phone_numbers(f'+1{destination}').fetch(type='carrier')
-            carrier_name = phone_number.carrier['name']
-            row['Carrier'] = carrier_name
-            carrier_count[carrier_name] += 1
-
-        writer.writerow(row)
+    rows = list(csv_rows(reader, len(header)))
+    error_count = Counter(row[error_index] for row in rows)
+    carrier_count = Counter(asyncio.run(write_carrier_rows(rows, writer, error_index, to_index)))
 
     if not quiet:
         click.echo('Results')
         click.echo('(full results in text_errors_carrier.csv)\n')
 
         click.echo('Breakdown by error type:')
-        for key, value in error_count.items():
-            click.echo(f'{key}: {value}')
+        echo_lines(f'{key}: {value}' for key, value in error_count.items())
 
         click.echo('')
 
-        print('30007 breakdown by carrier:')
-        for key, value in carrier_count.items():
-            click.echo(f'{key}: {value}')
+        click.echo('30007 breakdown by carrier:')
+        echo_lines(f'{key}: {value}' for key, value in carrier_count.items())
 
 
 @cli.group()
@@ -282,23 +659,17 @@ def van():
 @click.argument('campaign-id')
 def sync_responses(campaign_id):
     """Re-send survey responses to VAN."""
-    if not DATABASE_URL:
+    import asyncio
+
+    database_url = getenv('DATABASE_URL')
+    van_api_key = getenv('VAN_API_KEY')
+    if not database_url:
         raise click.Abort('DATABASE_URL environment variable is required!')
-    if not VAN_API_KEY:
+    if not van_api_key:
         raise click.Abort('VAN_API_KEY environment variable is required!')
 
-    result = urlparse(DATABASE_URL)
-    username = result.username
-    password = result.password
-    database = result.path[1:]
-    hostname = result.hostname
-    connection = psycopg2.connect(
-        database=database,
-        user=username,
-        password=password,
-        host=hostname
-    )
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    db_pool = get_db_pool()
+    connection = db_pool.getconn()
 
     # 1. Limit question responses to the specified campaign via `campaign_contact.campaign_id`
     # 2. Limit interaction steps to the specified campaign
@@ -306,14 +677,7 @@ def sync_responses(campaign_id):
     #    `answer_option` (seems like this should really be a foreign key...)
     # 4. Ignore question responses that don't map to an external response
     # 5. Grab the external question from the parent interaction step
-    # 6. Select fields necessary to submit to external system
-    cursor.execute(f'''
-        SELECT qr.id AS qr_id,
-            to_json(qr.created_at) AS qr_created_at,
-            qr.value AS qr_value,
-            cc.external_id AS cc_external_id,
-            istep.external_response,
-            pstep.external_question AS external_question
+    query_from = '''
         FROM question_response AS qr
         INNER JOIN campaign_contact AS cc
             ON qr.campaign_contact_id = cc.id
@@ -321,54 +685,52 @@ def sync_responses(campaign_id):
             ON qr.value = istep.answer_option
         INNER JOIN interaction_step AS pstep
             ON istep.parent_interaction_id = pstep.id
-        WHERE cc.campaign_id = {campaign_id}
-            AND istep.campaign_id = {campaign_id}
-            AND istep.external_response != '';
-        ''')
-
-    records = cursor.fetchall()
-    errors = []
-
-    click.echo(f'There are {len(records)} records')
-
-    with click.progressbar(records, label='Updating records') as progess_bar:
-        for record in progess_bar:
-            cc_external_id = record['cc_external_id']
-            action_date = record['qr_created_at']
-            external_question = record['external_question']
-            external_response = int(record['external_response'])
-
-            url = f'https://osdi.ngpvan.com/api/v1/people/{cc_external_id}/record_canvass_helper/'
-
-            headers = {
-                'OSDI-Api-Token': VAN_API_KEY,
-                'Content-type': 'application/hal+json',
-            }
-
-            body = {
-                'canvass': {
-                    'action_date': action_date,
-                    'contact_type': 'SMS Text',
-                    'success': True,
-                    'status_code': '',
-                },
-                'add_answers': [{
-                    'question': external_question,
-                    'responses': [external_response],
-                }],
-            }
-
-            result = requests.post(url, headers=headers, json=body)
+        WHERE cc.campaign_id = %(campaign_id)s
+            AND istep.campaign_id = %(campaign_id)s
+            AND istep.external_response != ''
+        '''
+    query_params = {'campaign_id': campaign_id}
+
+    with connection.cursor() as count_cursor:
+        count_cursor.execute(f'SELECT count(DISTINCT cc.external_id) {query_from};', query_params)
+        record_count = count_cursor.fetchone()[0]
+
+    # 6. Build one request body per contact for the external system as JSON text, combining all
+    #    of the contact's answers into a single canvass dated by their latest response
+    # 7. Stream (id, body) tuples from a server-side cursor rather than loading every record into
+    #    memory
+    cursor = connection.cursor(name='sync_responses')
+    cursor.execute(f'''
+        SELECT cc.external_id AS cc_external_id,
+            json_build_object(
+                'canvass', json_build_object(
+                    'action_date', max(qr.created_at),
+                    'contact_type', 'SMS Text',
+                    'success', true,
+                    'status_code', ''
+                ),
+                'add_answers', json_agg(json_build_object(
+                    'question', pstep.external_question,
+                    'responses', json_build_array(istep.external_response::int)
+                ))
+            )::text AS body
+        {query_from}
+        GROUP BY cc.external_id;
+        ''', query_params)
+
+    click.echo(f'There are {record_count} contacts with responses')
 
-            if result.status_code != 200:
-                errors.append((cc_external_id, result.status_code, result.reason))
+    try:
+        with click.progressbar(length=record_count, label='Updating records') as progess_bar:
+            errors = asyncio.run(post_canvass_responses(cursor, progess_bar, van_api_key))
+    finally:
+        cursor.close()
+        db_pool.putconn(connection)
 
     click.echo('Completed')
     if errors:
         click.echo('Erros:')
-        pprint(errors)
-
-    connection.close()
+        click.echo(pformat(errors))
 
 
 @cli.group()
@@ -391,96 +753,103 @@ def spoke():
 @click.argument('opt-outs-input', type=click.File('r'))
 def upload_opt_outs(number_column, organization_id, campaign_id, assignment_id, user_id, opt_outs_input):
     """Upload list of opt-outs to Spoke."""
-    if not DATABASE_URL:
+    import psycopg2.extras
+
+    database_url = getenv('DATABASE_URL')
+    if not database_url:
         raise click.Abort('DATABASE_URL environment variable is required!')
 
-    result = urlparse(DATABASE_URL)
-    username = result.username
-    password = result.password
-    database = result.path[1:]
-    hostname = result.hostname
-    connection = psycopg2.connect(
-        database=database,
-        user=username,
-        password=password,
-        host=hostname
-    )
+    db_pool = get_db_pool()
+    connection = db_pool.getconn()
     cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    # reader = csv.DictReader(opt_outs_input)
+    reader = csv.DictReader(opt_outs_input)
 
     def exit_smoothly(message=None, exc=None):
-        """Handle exits (with errors)."""
+        """Handle exits, raising a ClickException when there is an error to report."""
         cursor.close()
-        connection.close()
+        db_pool.putconn(connection)
 
         if exc:
-            if not message:
-                message = 'There was an error:'
-            click.echo(message)
-            click.Abort(str(exc))
-        elif message:
-            click.Abort(message)
+            raise click.ClickException(f'{message or "There was an error"}: {exc}')
+        if message:
+            raise click.ClickException(message)
 
     # Parse list
-    try:
-        opt_out_numbers = [(format_cell(row[number_column]),) for row in reader]
-    except KeyError:
+    if number_column not in (reader.fieldnames or []):
         exit_smoothly(f'Column {number_column} does not exist!')
+    opt_out_csv = io.StringIO()
+    csv.writer(opt_out_csv, lineterminator='\n').writerows(
+        (format_cell(row[number_column]),) for row in reader
+    )
+    opt_out_csv.seek(0)
 
-    if not campaign_id:
-        # Create dummy campaign to link opt-outs to
-        title = 'Dummy Opt-Out Holder'
-        description = ('This campaign was created as part of uploading an existing opt-out list. '
-                       'Do not touch!')
-        campaign_sql = ('INSERT INTO campaign '
-                        '(organization_id, title, description, is_archived) '
-                        f'VALUES ({organization_id}, \'{title}\', \'{description}\', true) '
-                        'RETURNING id;')
-        try:
-            cursor.execute(campaign_sql)
-            campaign_id = cursor.fetchone()[0]
-            print(f'Created dummy campaign with ID: {campaign_id}')
-        except Exception as exc:
-            connection.rollback()
-            exit_smoothly('Error inserting dummy campaign', exc)
+    # Bulk load the opt-outs into a temporary table with COPY, which is much faster than INSERT for
+    # large lists; the final INSERT ... SELECT below still skips duplicates
+    try:
+        cursor.execute('CREATE TEMPORARY TABLE opt_out_upload (cell text) ON COMMIT DROP;')
+        cursor.copy_expert('COPY opt_out_upload (cell) FROM STDIN WITH (FORMAT csv);', opt_out_csv)
+    except Exception as exc:
+        connection.rollback()
+        exit_smoothly('Error loading opt-outs', exc)
 
+    # Create whichever dummy campaign and assignment are needed to link the opt-outs to, insert
+    # the opt-outs and count them, all in a single statement
+    ctes = []
     if not assignment_id:
-        # Create dummy assignment to link opt-outs to
-        assignment_sql = ('INSERT INTO assignment '
-                          '(user_id, campaign_id, max_contacts) '
-                          f'VALUES ({user_id}, {campaign_id}, 0) '
-                          'RETURNING id;')
-        try:
-            cursor.execute(assignment_sql)
-            assignment_id = cursor.fetchone()[0]
-            print(f'Created dummy assignment with ID: {assignment_id}')
-        except Exception as exc:
-            connection.rollback()
-            exit_smoothly('Error inserting dummy assignment:', exc)
-
-    # Insert Opt-Outs
-    data = [(number, assignment_id, organization_id, 'manual_upload')
-            for number in opt_out_numbers]
-    insert_query = ('INSERT INTO opt_out '
-                    '(cell, assignment_id, organization_id, reason_code) '
-                    'VALUES %s ON CONFLICT DO NOTHING;')
+        if not campaign_id:
+            ctes.append('''
+                new_campaign AS (
+                    INSERT INTO campaign (organization_id, title, description, is_archived)
+                    VALUES (%(organization_id)s, %(title)s, %(description)s, true)
+                    RETURNING id
+                )''')
+            campaign_source = '(SELECT id FROM new_campaign)'
+        else:
+            campaign_source = '%(campaign_id)s'
+        ctes.append(f'''
+            link AS (
+                INSERT INTO assignment (user_id, campaign_id, max_contacts)
+                VALUES (%(user_id)s, {campaign_source}, 0)
+                RETURNING campaign_id, id AS assignment_id
+            )''')
+    else:
+        ctes.append('''
+            link AS (
+                SELECT %(campaign_id)s::integer AS campaign_id,
+                    %(assignment_id)s::integer AS assignment_id
+            )''')
+    ctes.append('''
+        inserted AS (
+            INSERT INTO opt_out (cell, assignment_id, organization_id, reason_code)
+            SELECT opt_out_upload.cell, link.assignment_id, %(organization_id)s, 'manual_upload'
+            FROM link, opt_out_upload
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )''')
+    upload_sql = (f'WITH {",".join(ctes)} '
+                  'SELECT campaign_id, assignment_id, (SELECT count(*) FROM inserted) FROM link;')
+    upload_params = {
+        'organization_id': organization_id,
+        'campaign_id': campaign_id,
+        'assignment_id': assignment_id,
+        'user_id': user_id,
+        'title': 'Dummy Opt-Out Holder',
+        'description': ('This campaign was created as part of uploading an existing opt-out list. '
+                        'Do not touch!'),
+    }
     try:
-        psycopg2.extras.execute_values(
-            cursor, insert_query, data, template=None, page_size=100
-        )
+        cursor.execute(upload_sql, upload_params)
+        new_campaign_id, new_assignment_id, insert_count = cursor.fetchone()
         # Wait until final operation succeeds to commit
         connection.commit()
-        print('Executed bulk insert.')
     except Exception as exc:
         connection.rollback()
         exit_smoothly('Error inserting opt-outs', exc)
 
-    confirm_sql = f'SELECT count(*) FROM opt_out WHERE assignment_id = %s;'
-    try:
-        cursor.execute(confirm_sql, (assignment_id))
-        insert_count = cursor.fetchone()[0]
-        print(f'Inserted {insert_count} Opt-Out records.')
-    except Exception as exc:
-        exit_smoothly('There was an error fetching the insert count', exc)
+    if not assignment_id:
+        if not campaign_id:
+            print(f'Created dummy campaign with ID: {new_campaign_id}')
+        print(f'Created dummy assignment with ID: {new_assignment_id}')
+    print(f'Inserted {insert_count} Opt-Out records.')
 
     exit_smoothly()
@@ -3,7 +3,7 @@ Helper scripts for the Abdul for Michigan campaign.
 """
 from setuptools import find_packages, setup
 
-dependencies = ['click', 'python-dotenv', 'twilio', 'psycopg2']
+dependencies = ['aiohttp', 'click', 'python-dotenv', 'twilio', 'psycopg2']
 
 setup(
     name='afm',
@@ -19,6 +19,9 @@ setup(
     zip_safe=False,
     platforms='any',
     install_requires=dependencies,
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'afm = afm.cli:cli',
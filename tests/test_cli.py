@@ -1,3 +1,9 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import time
+from unittest import mock
+
 import pytest
 from click.testing import CliRunner
 from afm import cli
@@ -27,3 +33,377 @@ def test_cli_with_arg(runner):
     assert result.exit_code == 0
     assert not result.exception
     assert result.output.strip() == 'Hello, Benjamin.'
+
+
+def test_sms_keeps_row_order(runner, monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, 'lookup_carrier', lambda destination: f'carrier-{destination}')
+    csv_input = tmp_path / 'errors.csv'
+    csv_input.write_text('ErrorCode,To\n30007,3135550001\n\n30003,3135550002\n30007,3135550003\n\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['twilio', 'sms', '-q', str(csv_input), str(csv_output)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert csv_output.read_text() == ('ErrorCode,To,Carrier\n'
+                                      '30007,3135550001,carrier-+13135550001\n'
+                                      '30003,3135550002,\n'
+                                      '30007,3135550003,carrier-+13135550003\n')
+
+
+@pytest.mark.parametrize('use_arrow', [False, True])
+@pytest.mark.parametrize('bom', ['', '\ufeff'])
+# Arrow rejects ragged rows, so this also covers falling back to the csv module
+@pytest.mark.parametrize('ragged_row', ['', '48204,5550005555\n'])
+def test_dedup(runner, monkeypatch, tmp_path, use_arrow, bom, ragged_row):
+    if not use_arrow:
+        monkeypatch.setattr(cli, 'has_pyarrow', lambda: False)
+    elif not cli.has_pyarrow():
+        pytest.skip('pyarrow is not installed')
+    superset_csv = tmp_path / 'superset.csv'
+    superset_csv.write_text(f'{bom}zip,cell,name\n01234,+15550001111,Ada\n,5550002222,Bob\n'
+                            '48201,15550003333,Cy\n\n48202,555-000-4444,"Dee, Jr."\n\n'
+                            f'48203,0005550001,Eve\n{ragged_row}')
+    subset_csv = tmp_path / 'subset.csv'
+    subset_csv.write_text('contact[cell]\n+15550002222\n\n(555) 000-3333\n\n5550001\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['analysis', 'dedup',
+                                     str(superset_csv), str(subset_csv), str(csv_output)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert 'Removed 2 duplicate numbers.' in result.output
+    assert csv_output.read_text() == (f'{bom}zip,cell,name\n01234,+15550001111,Ada\n'
+                                      '48202,555-000-4444,"Dee, Jr."\n'
+                                      f'48203,0005550001,Eve\n{ragged_row}')
+
+
+def test_sms_short_rows(runner, monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, 'lookup_carrier', lambda destination: 'carrier')
+    csv_input = tmp_path / 'errors.csv'
+    csv_input.write_text('ErrorCode,To,Body\n30007,3135550001\n30003\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['twilio', 'sms', str(csv_input), str(csv_output)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert csv_output.read_text() == ('ErrorCode,To,Body,Carrier\n'
+                                      '30007,3135550001,,carrier\n'
+                                      '30003,,,\n')
+    assert '30007: 1\n30003: 1\n' in result.output
+
+
+def test_sms_looks_up_each_destination_once(runner, monkeypatch, tmp_path):
+    lookups = []
+
+    def lookup_carrier(destination):
+        lookups.append(destination)
+        return 'carrier'
+
+    monkeypatch.setattr(cli, 'lookup_carrier', lookup_carrier)
+    csv_input = tmp_path / 'errors.csv'
+    csv_input.write_text('ErrorCode,To\n30007,3135550001\n30007,+13135550001\n30007,3135550002\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['twilio', 'sms', str(csv_input), str(csv_output)])
+    assert not result.exception
+    assert sorted(lookups) == ['+13135550001', '+13135550002']
+    assert 'carrier: 3' in result.output
+
+
+def test_purchase_writes_rows_in_order(runner, monkeypatch, tmp_path):
+    client = mock.MagicMock()
+    client.available_phone_numbers.return_value.local.list.side_effect = lambda area_code: [
+        mock.Mock(phone_number=f'+1{area_code}555000{i}') for i in range(3)
+    ]
+    monkeypatch.setattr(cli, 'get_client', lambda: client)
+    csv_input = tmp_path / 'order.csv'
+    csv_input.write_text('area_code,quantity\n313,2\n\n248,1\n\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['twilio', 'purchase', str(csv_input), str(csv_output)],
+                           input='y\n')
+    assert not result.exception
+    assert result.exit_code == 0
+    assert client.incoming_phone_numbers.create.call_count == 3
+    assert csv_output.read_text() == ('area_code,number,purchase_status,service_status,message\n'
+                                      '313,+13135550000,success,,\n'
+                                      '313,+13135550001,success,,\n'
+                                      '248,+12485550000,success,,\n')
+
+
+def test_purchase_adds_to_service_with_purchased_sid(runner, monkeypatch, tmp_path):
+    client = mock.MagicMock()
+    client.available_phone_numbers.return_value.local.list.return_value = [
+        mock.Mock(phone_number='+13135550000')
+    ]
+    client.incoming_phone_numbers.create.return_value = mock.Mock(sid='PN123')
+    monkeypatch.setattr(cli, 'get_client', lambda: client)
+    csv_input = tmp_path / 'order.csv'
+    csv_input.write_text('area_code,quantity\n313,1\n')
+    csv_output = tmp_path / 'out.csv'
+
+    result = runner.invoke(cli.cli, ['twilio', 'purchase', '-s', 'MG123',
+                                     str(csv_input), str(csv_output)], input='y\n')
+    assert not result.exception
+    assert not client.incoming_phone_numbers.list.called
+    client.messaging.services.assert_called_once_with('MG123')
+    client.messaging.services.return_value.phone_numbers.create.assert_called_once_with(
+        phone_number_sid='PN123'
+    )
+    assert '313,+13135550000,success,success,' in csv_output.read_text()
+
+
+def test_service_add_prefetches_numbers(runner, monkeypatch, tmp_path):
+    client = mock.MagicMock()
+    client.incoming_phone_numbers.list.return_value = [
+        mock.Mock(phone_number='+13135550000', sid='PN1'),
+        mock.Mock(phone_number='+13135550001', sid='PN2'),
+    ]
+    monkeypatch.setattr(cli, 'get_client', lambda: client)
+    csv_input = tmp_path / 'numbers.csv'
+    csv_input.write_text('number\n+13135550001\n+13135559999\n3135550000\n')
+
+    result = runner.invoke(cli.cli, ['twilio', 'service', 'add', str(csv_input), 'MG123'])
+    assert not result.exception
+    client.incoming_phone_numbers.list.assert_called_once_with()
+    create = client.messaging.services.return_value.phone_numbers.create
+    assert sorted(call.kwargs['phone_number_sid'] for call in create.call_args_list) == [
+        'PN1', 'PN2'
+    ]
+    assert 'Number +13135559999 was not found. Skipping.' in result.output
+
+
+def test_number_stats(runner, tmp_path):
+    csv_input = tmp_path / 'log.csv'
+    csv_input.write_text('From,Direction\n+1111,outbound-api\n+2222,inbound\n\n'
+                         '+1111,outbound-api\n+3333,outbound-api\n\n')
+
+    result = runner.invoke(cli.cli, ['analysis', 'number-stats', str(csv_input)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert result.output == 'Breakdown by number sent from:\n+1111: 2\n+3333: 1\n'
+
+
+def test_number_stats_short_rows(runner, tmp_path):
+    csv_input = tmp_path / 'log.csv'
+    csv_input.write_text('From,Direction\n+1111,outbound-api\n+2222\n')
+
+    result = runner.invoke(cli.cli, ['analysis', 'number-stats', str(csv_input)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert result.output == 'Breakdown by number sent from:\n+1111: 1\n+2222: 1\n'
+
+
+@pytest.mark.parametrize('cell', ['3135550001', '+13135550001', '(313) 555-0001', ' 313.555.0001\n'])
+def test_format_cell(cell):
+    assert cli.format_cell(cell) == '+13135550001'
+
+
+def test_get_client_is_created_once_across_threads(monkeypatch):
+    created = []
+
+    def create_client():
+        time.sleep(0.01)
+        created.append(object())
+        return created[-1]
+
+    monkeypatch.setattr(cli, '_client', None)
+    monkeypatch.setattr(cli, 'create_client', create_client)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: cli.get_client(), range(8)))
+
+    assert len(created) == 1
+    assert all(client is created[0] for client in clients)
+
+
+class FakeCursor:
+    def __init__(self, records):
+        self.records = list(records)
+
+    def fetchmany(self, size):
+        batch, self.records = self.records[:size], self.records[size:]
+        return batch
+
+
+class FakeProgressBar:
+    def __init__(self):
+        self.count = 0
+
+    def update(self, count):
+        self.count += count
+
+
+def fake_aiohttp_session(responses):
+    """Build a stand-in for aiohttp.ClientSession that replays `responses` per URL in order.
+
+    Each response is a status code, a (status code, headers) tuple or an exception to raise.
+    """
+    class FakeSession:
+        def __init__(self, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+        @contextlib.asynccontextmanager
+        async def post(self, url, data):
+            response = responses[url].pop(0)
+            if isinstance(response, Exception):
+                raise response
+            status, headers = response if isinstance(response, tuple) else (response, {})
+            yield mock.Mock(status=status, reason=f'status {status}', headers=headers)
+
+    return FakeSession
+
+
+def connector_error(aiohttp):
+    """Build the error aiohttp raises when it cannot connect to VAN at all."""
+    connection_key = mock.Mock(host='osdi.ngpvan.com', port=443, ssl=True)
+    return aiohttp.ClientConnectorError(connection_key, ConnectionRefusedError(111, 'refused'))
+
+
+def run_post_canvass_responses(monkeypatch, responses):
+    aiohttp = pytest.importorskip('aiohttp')
+    monkeypatch.setattr(cli, 'VAN_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(aiohttp, 'ClientSession', fake_aiohttp_session(responses))
+    records = [(external_id, '{}') for external_id in range(len(responses))]
+    progress_bar = FakeProgressBar()
+    errors = asyncio.run(cli.post_canvass_responses(FakeCursor(records), progress_bar, 'key'))
+    return errors, progress_bar.count
+
+
+def test_post_canvass_responses_retries_until_success(monkeypatch):
+    aiohttp = pytest.importorskip('aiohttp')
+    responses = {
+        cli.VAN_CANVASS_URL.format(0): [200],
+        cli.VAN_CANVASS_URL.format(1): [connector_error(aiohttp), 429, 200],
+        cli.VAN_CANVASS_URL.format(2): [(429, {'Retry-After': '0'}), 200],
+    }
+
+    errors, completed = run_post_canvass_responses(monkeypatch, responses)
+    assert errors == []
+    assert completed == 3
+    assert all(not remaining for remaining in responses.values())
+
+
+def test_post_canvass_responses_reports_exhausted_retries(monkeypatch):
+    aiohttp = pytest.importorskip('aiohttp')
+    retries = cli.VAN_RETRIES + 1
+    responses = {
+        cli.VAN_CANVASS_URL.format(0): [429] * retries,
+        cli.VAN_CANVASS_URL.format(1): [connector_error(aiohttp)] * retries,
+        cli.VAN_CANVASS_URL.format(2): [404],
+        cli.VAN_CANVASS_URL.format(3): [200],
+        # These requests may already have been recorded, so they are not sent again
+        cli.VAN_CANVASS_URL.format(4): [503],
+        cli.VAN_CANVASS_URL.format(5): [504],
+        cli.VAN_CANVASS_URL.format(6): [asyncio.TimeoutError()],
+        cli.VAN_CANVASS_URL.format(7): [aiohttp.ServerDisconnectedError()],
+        # Waiting this long would stall a worker, so the contact is reported instead
+        cli.VAN_CANVASS_URL.format(8): [(429, {'Retry-After': '86400'})],
+    }
+
+    errors, completed = run_post_canvass_responses(monkeypatch, responses)
+    assert sorted(errors) == [
+        (0, 429, 'status 429'),
+        (1, None, 'Cannot connect to host osdi.ngpvan.com:443 ssl:default [refused]'),
+        (2, 404, 'status 404'), (4, 503, 'status 503'), (5, 504, 'status 504'),
+        (6, None, 'TimeoutError'), (7, None, 'Server disconnected'), (8, 429, 'status 429'),
+    ]
+    assert completed == 9
+    assert all(not remaining for remaining in responses.values())
+
+
+@pytest.fixture
+def db_pool(monkeypatch):
+    """Replace the Postgres pool with a mock, returning the pool."""
+    pytest.importorskip('psycopg2')
+    pool = mock.MagicMock()
+    monkeypatch.setenv('DATABASE_URL', 'postgres://localhost/spoke')
+    monkeypatch.setattr(cli, 'get_db_pool', lambda: pool)
+    return pool
+
+
+def test_upload_opt_outs_reports_missing_column(runner, db_pool, tmp_path):
+    opt_outs_input = tmp_path / 'opt_outs.csv'
+    opt_outs_input.write_text('cell\n3135550001\n')
+
+    result = runner.invoke(cli.cli, ['spoke', 'upload-opt-outs', '-o', '1', '-a', '5',
+                                     str(opt_outs_input)])
+    assert result.exit_code == 1
+    assert 'Error: Column phone does not exist!' in result.output
+    connection = db_pool.getconn.return_value
+    assert not connection.cursor.return_value.execute.called
+    db_pool.putconn.assert_called_once_with(connection)
+
+
+def test_upload_opt_outs_reports_copy_errors(runner, db_pool, tmp_path):
+    connection = db_pool.getconn.return_value
+    connection.cursor.return_value.copy_expert.side_effect = Exception('bad COPY data')
+    opt_outs_input = tmp_path / 'opt_outs.csv'
+    opt_outs_input.write_text('phone\n3135550001\n')
+
+    result = runner.invoke(cli.cli, ['spoke', 'upload-opt-outs', '-o', '1', '-a', '5',
+                                     str(opt_outs_input)])
+    assert result.exit_code == 1
+    assert 'Error: Error loading opt-outs: bad COPY data' in result.output
+    connection.rollback.assert_called_once_with()
+    assert not connection.commit.called
+    db_pool.putconn.assert_called_once_with(connection)
+
+
+@pytest.mark.parametrize('options, sql_fragments, output', [
+    (['-u', '7'],
+     ['new_campaign AS (\n                    INSERT INTO campaign',
+      'VALUES (%(user_id)s, (SELECT id FROM new_campaign), 0)'],
+     'Created dummy campaign with ID: 3\nCreated dummy assignment with ID: 5\n'),
+    (['-u', '7', '-c', '3'],
+     ['VALUES (%(user_id)s, %(campaign_id)s, 0)'],
+     'Created dummy assignment with ID: 5\n'),
+    (['-c', '3', '-a', '5'],
+     ['SELECT %(campaign_id)s::integer AS campaign_id'],
+     ''),
+])
+def test_upload_opt_outs(runner, db_pool, tmp_path, options, sql_fragments, output):
+    connection = db_pool.getconn.return_value
+    cursor = connection.cursor.return_value
+    cursor.fetchone.return_value = ('3', '5', 2)
+    copied = []
+    cursor.copy_expert.side_effect = lambda sql, csv_file: copied.append((sql, csv_file.read()))
+    opt_outs_input = tmp_path / 'opt_outs.csv'
+    opt_outs_input.write_text('name,phone\nAda,(313) 555-0001\nBob,+13135550002\n')
+
+    result = runner.invoke(cli.cli, ['spoke', 'upload-opt-outs', '-o', '1', *options,
+                                     str(opt_outs_input)])
+    assert not result.exception
+    assert result.exit_code == 0
+    assert result.output == output + 'Inserted 2 Opt-Out records.\n'
+
+    assert copied == [('COPY opt_out_upload (cell) FROM STDIN WITH (FORMAT csv);',
+                       '+13135550001\n+13135550002\n')]
+    create_call, upload_call = cursor.execute.call_args_list
+    assert create_call.args[0].startswith('CREATE TEMPORARY TABLE opt_out_upload')
+    upload_sql, upload_params = upload_call.args
+    for fragment in sql_fragments:
+        assert fragment in upload_sql
+    assert ('INSERT INTO campaign' in upload_sql) == ('-c' not in options)
+    assert ('INSERT INTO assignment' in upload_sql) == ('-a' not in options)
+    assert 'INSERT INTO opt_out' in upload_sql
+    assert upload_sql.endswith(
+        'SELECT campaign_id, assignment_id, (SELECT count(*) FROM inserted) FROM link;'
+    )
+    option_values = dict(zip(options[::2], options[1::2]))
+    assert upload_params == {
+        'organization_id': '1',
+        'campaign_id': option_values.get('-c'),
+        'assignment_id': option_values.get('-a'),
+        'user_id': option_values.get('-u'),
+        'title': 'Dummy Opt-Out Holder',
+        'description': ('This campaign was created as part of uploading an existing opt-out '
+                        'list. Do not touch!'),
+    }
+    connection.commit.assert_called_once_with()
+    db_pool.putconn.assert_called_once_with(connection)